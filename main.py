@@ -63,44 +63,54 @@
 #
 
 import sys
-from enum import Enum
 
 
-class SubCommandType(Enum):
+# plain int constants rather than an Enum; match compares them as ints
+class SubCommandType:
     SUB_COMMAND_TYPE = 1
     ARGUMENT = 2
     LABEL = 3
     APPEND = 4  # appending bits
 
 
-def format_sub_command(command, argument, current_argument):
-    return command.subcommands[current_argument][argument.upper()]
+# every machine instruction is this many bits wide
+__INSTRUCTION_SIZE__ = 16
 
 
-def format_argument(command, argument, line_num):
-    return dec2comp8(int(argument), line_num)
-
-
-def format_label(command, argument, label):
-    return ("{0:0" + str(command.label) + "b}").format(label[argument])
+# addresses are unsigned 8-bit values, other arguments are 8-bit 2-s complement
+def format_argument(argument, line_num, address=False):
+    try:
+        d = int(argument)
+    except ValueError:
+        sys.exit('Invalid %s on line %d' % ("address" if address else "decimal number", line_num))
+    if address:
+        return dec2bin8(d, line_num)
+    return dec2comp8(d, line_num)
 
 
 class Command:
     def __init__(self, opcode):
         self.subcommands = []
         self.argument = 0
+        self.address = False
         self.opcode = opcode
         self.label = 0
         self.order = []
         self.appended_bits = []
+        self.sub_command_bits = []
+        self._format = self._compile_and_format  # compiled once, on the first format() call
 
     def add_sub_command(self, op_dict):
+        # tokenize() lower cases every operand; the tables are written as bit strings but encoded as ints
+        self.sub_command_bits.append(len(next(iter(op_dict.values()))))
+        op_dict = {key.lower(): int(value, 2) for key, value in op_dict.items()}
         self.subcommands.append(op_dict)
         self.order.append(SubCommandType.SUB_COMMAND_TYPE)
         return self
 
-    def add_argument(self, length: int):
+    def add_argument(self, length: int, address: bool = False):
         self.argument = length
+        self.address = address
         self.order.append(SubCommandType.ARGUMENT)
         return self
 
@@ -120,27 +130,54 @@ class Command:
         self.order.append(SubCommandType.APPEND)
         return self
 
-    def format(self, args, labels):  # make sure the first args is the first argument and not the command itself
-        result = self.opcode
+    # generates a straight-line function that builds this command's machine word, e.g. for ADD:
+    # return 32768 | table0[args[0]] << 9 | table1[args[1]] << 6 | table2[args[2]]
+    def _compile(self):
+        fields = []  # (expression, width) from the most significant bits down
+        namespace = {"format_argument": format_argument, "dec2bin8": dec2bin8}
         current_indices = 0
         current_sub_command = 0
         current_append = 0
         for command_type in self.order:
             match command_type:
                 case SubCommandType.APPEND:
-                    result += '0' * self.appended_bits[current_append]
+                    fields.append((None, self.appended_bits[current_append]))
                     current_append += 1
                     continue
-                case SubCommandType.SUB_COMMAND_TYPE:  # SUB_COMMAND_TYPE
-                    result += format_sub_command(self, args[current_indices], current_sub_command)
-                case SubCommandType.ARGUMENT:  # ARGUMENT
-                    result += format_argument(self, args[current_indices], current_indices)
-                case SubCommandType.LABEL:  # LABEL
-                    result += str(format_label(self, args[current_indices], labels))
-                case _:
-                    pass
+                case SubCommandType.SUB_COMMAND_TYPE:
+                    table = "table" + str(current_sub_command)
+                    namespace[table] = self.subcommands[current_sub_command]
+                    fields.append(("%s[args[%d]]" % (table, current_indices),
+                                   self.sub_command_bits[current_sub_command]))
+                    current_sub_command += 1
+                case SubCommandType.ARGUMENT:
+                    fields.append(("format_argument(args[%d], line_num, %s)" % (current_indices, self.address),
+                                   self.argument))
+                case SubCommandType.LABEL:
+                    fields.append(("dec2bin8(labels[args[%d]], line_num)" % current_indices, self.label))
             current_indices += 1
-        return result
+
+        # commands narrower than an instruction are padded with zeros on the right
+        shift = __INSTRUCTION_SIZE__ - len(self.opcode)
+        terms = [str(int(self.opcode, 2) << shift)]
+        for expression, width in fields:
+            shift -= width
+            if expression is not None:  # appended bits are always zero
+                terms.append("%s << %d" % (expression, shift) if shift else expression)
+        source = "def _format(args, labels, line_num):\n    return %s\n" % " | ".join(terms)
+        exec(source, namespace)
+        self._format = namespace["_format"]
+
+    # the builder calls are finished by the time a command is first formatted
+    def _compile_and_format(self, args, labels, line_num):
+        self._compile()
+        return self._format(args, labels, line_num)
+
+    # returns the machine word as an int __INSTRUCTION_SIZE__ bits wide
+    # line_num is the source line, used in error messages
+    # make sure the first args is the first argument and not the command itself
+    def format(self, args, labels, line_num):
+        return self._format(args, labels, line_num)
 
 
 __TABLE_B__ = {
@@ -185,12 +222,12 @@ __TABLE_E__ = {
     "ONES": "111"
 }
 
-__LOAD__ = Command("00000").add_sub_command(__TABLE_B__).add_argument(8)
+__LOAD__ = Command("00000").add_sub_command(__TABLE_B__).add_argument(8, address=True)
 # notice an extra 0 or 1 at the end of the load
 # due to LOAD not wanting to move register E
-__LOAD_A__ = Command("00001").add_sub_command(__TABLE_B__).add_argument(8)
-__STORE__ = Command("00010").add_sub_command(__TABLE_B__).add_argument(8)
-__STORE_A__ = Command("00011").add_sub_command(__TABLE_B__).add_argument(8)
+__LOAD_A__ = Command("00001").add_sub_command(__TABLE_B__).add_argument(8, address=True)
+__STORE__ = Command("00010").add_sub_command(__TABLE_B__).add_argument(8, address=True)
+__STORE_A__ = Command("00011").add_sub_command(__TABLE_B__).add_argument(8, address=True)
 __BRA__ = Command("00100000").add_label(8)
 __BRA_Z__ = Command("00110000").add_label(8)
 __BRA_N__ = Command("00110010").add_label(8)
@@ -203,16 +240,19 @@ __PUSH__ = Command("0100").add_sub_command(__TABLE_C__)
 __POP__ = Command("0101").add_sub_command(__TABLE_C__)
 __O_PORT__ = Command("0110").add_sub_command(__TABLE_D__)
 __I_PORT__ = Command("0111").add_sub_command(__TABLE_B__)
-__ADD__ = Command("1000").add_sub_command(__TABLE_E__).add_sub_command(__TABLE_B__).append_bits(3) \
-    .add_sub_command(__TABLE_E__)
-__SUB__ = Command("1001").add_sub_command(__TABLE_E__).add_sub_command(__TABLE_B__).append_bits(3) \
-    .add_sub_command(__TABLE_E__)
-__AND__ = Command("1010").add_sub_command(__TABLE_E__).add_sub_command(__TABLE_B__).append_bits(3) \
-    .add_sub_command(__TABLE_E__)
-__OR__ = Command("1011").add_sub_command(__TABLE_E__).add_sub_command(__TABLE_B__).append_bits(3) \
-    .add_sub_command(__TABLE_E__)
-__XOR__ = Command("1100").add_sub_command(__TABLE_E__).add_sub_command(__TABLE_B__).append_bits(3) \
-    .add_sub_command(__TABLE_E__)
+
+
+# ADD, SUB, AND, OR and XOR share one encoding and only differ in their opcode
+def alu_command(opcode):
+    return Command(opcode).add_sub_command(__TABLE_E__).add_sub_command(__TABLE_B__).append_bits(3) \
+        .add_sub_command(__TABLE_E__)
+
+
+__ADD__ = alu_command("1000")
+__SUB__ = alu_command("1001")
+__AND__ = alu_command("1010")
+__OR__ = alu_command("1011")
+__XOR__ = alu_command("1100")
 __SHIFT_L__ = Command("11010").add_sub_command(__TABLE_E__).append_bits(5).add_sub_command(
     __TABLE_B__)  # I'm using the sub command to auto add appended bits inbetween two bits
 __SHIFT_R__ = Command("11011").add_sub_command(__TABLE_E__).append_bits(5).add_sub_command(
@@ -254,148 +294,112 @@ __COMMAND_DICTIONARY__ = {
     "MOVEI": __MOVE_I__
 }
 
+# tokenize() lower cases every mnemonic, so pass2 looks commands up here
+__CMD_LC__ = {key.lower(): value for key, value in __COMMAND_DICTIONARY__.items()}
+
 
-# converts d to an 8-bit 2-s complement binary value
+# converts d to its 8-bit 2-s complement bit pattern
 def dec2comp8(d, linenum):
-    try:
-        if d > 0:
-            l = d.bit_length()
-            v = "00000000"
-            v = v[0:8 - l] + format(d, 'b')
-        elif d < 0:
-            dt = 128 + d
-            l = dt.bit_length()
-            v = "10000000"
-            v = v[0:8 - l] + format(dt, 'b')[:]
-        else:
-            v = "00000000"
-    except:
-        print
-        'Invalid decimal number on line %d' % (linenum)
-        exit()
-
-    return v
-
-
-# converts d to an 8-bit unsigned binary value
-def dec2bin8(d, linenum):
-    if d > 0:
-        l = d.bit_length()
-        v = "00000000"
-        v = v[0:8 - l] + format(d, 'b')
-    elif d == 0:
-        v = "00000000"
-    else:
-        print
-        'Invalid address on line %d: value is negative' % (linenum)
-        exit()
+    if not -128 <= d <= 127:
+        sys.exit('Invalid decimal number on line %d' % linenum)
+    return d & 0xFF
+
 
-    return v
+# checks that d fits in an 8-bit unsigned value
+def dec2bin8(d, linenum):
+    if not 0 <= d <= 255:
+        sys.exit('Invalid address on line %d' % linenum)
+    return d
 
 
 # Tokenizes the input data, discarding white space and comments
-# returns the tokens as a list of lists, one list for each line.
+# returns the tokens as a list of (line number, words) pairs, one for
+# each line, so later passes can report errors against the source.
 #
 # The tokenizer also converts each character to lower case.
 def tokenize(fp):
     tokens = []
 
-    # start of the file
-    fp.seek(0)
-
-    lines = fp.readlines()
-
-    # strip white space and comments from each line
-    for line in lines:
-        ls = line.strip()
-        uls = ''
-        for c in ls:
-            if c != '#':
-                uls = uls + c
-            else:
-                break
+    # read the file a line at a time, stripping comments and white space
+    for line_num, line in enumerate(fp, 1):
+        words = line.split('#', 1)[0].lower().split()
 
         # skip blank lines
-        if len(uls) == 0:
-            continue
-
-        # split on white space
-        words = uls.split()
-
-        newwords = []
-        for word in words:
-            newwords.append(word.lower())
-
-        tokens.append(newwords)
+        if words:
+            tokens.append((line_num, words))
 
     return tokens
 
 
 # reads through the file and returns a dictionary of all location
-# labels with their line numbers
+# labels with their addresses, along with the instructions as
+# (command, arguments, source line number) tuples
+#
+# label lines and unknown commands are left out of the instructions, so
+# each label points at the address of the instruction that follows it;
+# tokens is not modified
 def pass1(tokens):
-    line_number = 0
+    address = 0
     dictionary = {}
-    for label in tokens:
-        if label[0].endswith(":"):  # check to see if the line is formatted as a label
-            dictionary[label[0].replace(":", "")] = line_number  # add it to a dictionary
-            tokens.remove(label)  # remove the label
-        line_number += 1  # change current line number
+    instructions = []
+    for line_num, line in tokens:
+        if line[0].endswith(":"):  # check to see if the line is formatted as a label
+            dictionary[line[0][:-1]] = address  # add it to a dictionary
+            continue
+        command = __CMD_LC__.get(line[0])
+        if command is None:
+            continue
+        instructions.append((command, line[1:], line_num))
+        address += 1  # change current address
 
-    return dictionary
+    return dictionary, instructions
 
 
-def pass2(tokens, labels, __instruction_size__=16):
+def pass2(instructions, labels):
     argument_code = []
-    current_argument = 0
-    for line in tokens:
-        if not (line[0].upper() in __COMMAND_DICTIONARY__):
-            continue
-        command = __COMMAND_DICTIONARY__.get(line[0].upper())
-        line.pop(0)
-        argument_code.append("{:02x}".format(current_argument) + " : " + (command.format(line, labels))
-                             .ljust(__instruction_size__, '0'))  # add
+    for current_argument, (command, args, line_num) in enumerate(instructions):
+        try:
+            word = command.format(args, labels, line_num)
+        except KeyError as e:
+            sys.exit('Unknown register or label %s on line %d' % (e, line_num))
+        except IndexError:
+            sys.exit('Missing operand on line %d' % line_num)
+        argument_code.append("{:02x} : {:0{}b}".format(current_argument, word, __INSTRUCTION_SIZE__))  # add
         # formatted command
 
-        current_argument += 1
+    current_argument = len(argument_code)
     if not current_argument == 256:
         argument_code.append('[' + '{:02x}'.format(current_argument) + '..FF] : 11111111111111111')
     return argument_code
 
 
 def main(argv):
+    verbose = "-v" in argv  # only echo the tokens and instructions when asked to
+    argv = [arg for arg in argv if arg != "-v"]
     if len(argv) < 2:
-        print
-        'Usage: python %s <filename>' % (argv[0])
-        exit()
+        sys.exit('Usage: python %s [-v] <filename>' % (argv[0]))
     # open() is the python3 version of file()
-    fp = open(argv[1], 'rU')
+    with open(argv[1], 'r') as fp:
+        tokens = tokenize(fp)
 
-    tokens = tokenize(fp)
+    labels, instructions = pass1(tokens)
 
-    labels = pass1(tokens)
+    if verbose:
+        print([words for _, words in tokens])
 
-    print(tokens)
+    argument_code = pass2(instructions, labels)
 
-    argument_code = pass2(tokens, labels)
-
-    print(*argument_code, sep="\n")
-
-    f = open(argv[1].split(".")[0] + ".mif", "w")  # remove the .txt and add the .mif
+    if verbose:
+        print(*argument_code, sep="\n")
 
     # build the file
-    f.write("DEPTH = 256;\n")
-    f.write("WIDTH = 16;\n")
-    f.write("ADDRESS_RADIX = HEX;\n")
-    f.write("DATA_RADIX = BIN;\n")
-    f.write("CONTENT\n")
-    f.write("BEGIN\n")
-    for instruction in argument_code:
-        f.write(instruction + ";\n")
-    f.write("END")
-
-    f.close()
-    fp.close()
+    out = ["DEPTH = 256;", "WIDTH = %d;" % __INSTRUCTION_SIZE__, "ADDRESS_RADIX = HEX;", "DATA_RADIX = BIN;",
+           "CONTENT", "BEGIN"]
+    out += [instruction + ";" for instruction in argument_code]
+    out.append("END")
+
+    with open(argv[1].split(".")[0] + ".mif", "w") as f:  # remove the .txt and add the .mif
+        f.write("\n".join(out))
 
     # execute pass1 and pass2 then print it out as an MIF file
 